@@ -1,53 +1,141 @@
 import geopandas as gpd
 import pandas as pd
 import os
-from glob import glob
+import bisect
 from shapely.geometry import Point  # Ensure we can create geometries if needed
 from uvars import dpath, gpkg_fn
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:  # Fall back to pandas' CSV writer and an uncached laz index
+    pa = None
 
-def find_closest_match_datafile(datafile, basenames):
-    """Finds the closest matching file from a list of basenames (full paths)."""
+VALIDATE = False  # Patch missing geometry/CRS with placeholders (only needed for malformed GeoPackages)
+
+
+def find_closest_match_datafile(datafile, names, fullpaths):
+    """
+    Finds the first laz file whose basename starts with the datafile's base, by binary search over the
+    sorted basenames (names) and their full paths (fullpaths, same order).
+    """
     base_datafile = os.path.basename(datafile).split('_dn_')[0]  # Extract filename base
-    for fullpath in basenames:
-        basename = os.path.basename(fullpath)  # Extract filename from full path
-        if basename.startswith(base_datafile):
-            return fullpath  # Return full path, not just the basename
+    i = bisect.bisect_left(names, base_datafile)  # Names sharing the prefix sort right after it
+    if i < len(names) and names[i].startswith(base_datafile):
+        return fullpaths[i]  # Return full path, not just the basename
     return None
 
 
-# Get all laz files in subdirectories (full paths)
-lazfiles = glob(f"{dpath}/*/*.laz")
+def iter_laz(root):
+    """Yields (basename, full path) for every .laz file one directory below root, skipping hidden entries as glob did."""
+    for sub in os.scandir(root):
+        if not sub.name.startswith('.') and sub.is_dir():  # Follows symlinked directories, as glob did
+            for f in os.scandir(sub.path):
+                if not f.name.startswith('.') and f.name.endswith('.laz'):  # e.g. macOS '._tile.laz' files
+                    yield f.name, f.path
+
+
+def laz_prefix(name):
+    """Lookup key of a laz basename: the part before '_dn_', or the name without '.laz' if it has none."""
+    return name.split('_dn_')[0].removesuffix('.laz')
+
+
+def build_prefix_table(lazfiles):
+    """Builds the prefix (see laz_prefix) -> first full path table from (basename, full path) pairs."""
+    prefix_table = {}
+    for name, fullpath in lazfiles:
+        prefix_table.setdefault(laz_prefix(name), fullpath)  # Keep the first match, as the linear scan did
+    return prefix_table
+
+
+def index_laz(root):
+    """Walks root once, returning the laz (basename, full path) pairs and their prefix table."""
+    lazfiles = list(iter_laz(root))
+    return lazfiles, build_prefix_table(lazfiles)
+
+
+def get_index_mtime(root):
+    """Latest mtime of root and its subdirectories; changes whenever a laz file or subdirectory is added or removed."""
+    return max([os.stat(root).st_mtime] + [d.stat().st_mtime for d in os.scandir(root) if d.is_dir()])
+
+
+def load_laz_index(root, index_fn):
+    """
+    Returns index_laz(root), reusing the parquet sidecar index_fn when it was written for the current
+    directory mtime, and rewriting it otherwise. An unreadable sidecar counts as a cache miss, and the
+    sidecar is written to a temp file and renamed into place, so an interrupted write cannot corrupt it.
+    Without pyarrow the directory is always walked.
+    """
+    if pa is None:
+        return index_laz(root)
+    mtime = repr(get_index_mtime(root))
+    if os.path.exists(index_fn):
+        try:
+            table = pq.read_table(index_fn, columns=['name', 'filepath'])
+        except Exception as e:  # Corrupt, foreign or older-format file, rebuild it below
+            print(f"Warning: Could not read {index_fn} ({e}), rebuilding it.")
+            table = None
+        if table is not None and (table.schema.metadata or {}).get(b'dpath_mtime') == mtime.encode():
+            lazfiles = list(zip(table.column('name').to_pylist(), table.column('filepath').to_pylist()))
+            return lazfiles, build_prefix_table(lazfiles)
+    lazfiles, prefix_table = index_laz(root)
+    names, fullpaths = zip(*lazfiles) if lazfiles else ((), ())
+    table = pa.table({'name': pa.array(names, type=pa.string()), 'filepath': pa.array(fullpaths, type=pa.string())})
+    tmp_fn = f"{index_fn}.tmp"
+    pq.write_table(table.replace_schema_metadata({'dpath_mtime': mtime}), tmp_fn)
+    os.replace(tmp_fn, index_fn)
+    return lazfiles, prefix_table
+
+
+# Get all laz files in subdirectories (basenames and full paths)
+index_fn = gpkg_fn.replace('.gpkg', '.pathidx.parquet')  # Cached laz index, valid while dpath is unchanged
+lazfiles, prefix_table = load_laz_index(dpath, index_fn)  # (basename, full path) pairs; one scandir pass (or none on warm reruns), O(1) lookups afterwards
 print(f"Found {len(lazfiles)} laz files.")
 
-basenames = lazfiles  # Keeping full paths to match correctly
+# Sorted basenames (with full paths) for the prefix fallback, O(log M) per lookup
+sorted_laz = sorted(lazfiles)
+names = [name for name, _ in sorted_laz]
+fullpaths = [fullpath for _, fullpath in sorted_laz]
+
+# Read the original GeoPackage, keeping only the columns written out below
+metacols = ['id', 'transect', 'datafile', 'epsg', 'random', 'geometry', 'filepath']
+srccols = metacols[:-1]  # Everything but the 'filepath' column computed below
+gdf = gpd.read_file(gpkg_fn, engine="pyogrio", columns=[c for c in srccols if c != 'geometry'])
 
-# Read the original GeoPackage
-gdf = gpd.read_file(gpkg_fn)
+# Ensure it contains a geometry column (before the subset below, which needs one)
+if VALIDATE and 'geometry' not in gdf.columns:
+    print("Warning: No geometry column found! Adding dummy geometry.")
+    gdf = gpd.GeoDataFrame(gdf, geometry=[Point(0, 0)] * len(gdf))  # Placeholder geometry
 
-meta = gdf.copy()
+meta = gdf[srccols].copy()  # Fixes the column order, 'filepath' is appended last
+del gdf
 print(f"Loaded {gpkg_fn}: {len(meta)} records.")
 print("Meta DataFrame types:\n", meta.dtypes)
 
-# Ensure it contains a geometry column
-if 'geometry' not in meta.columns or meta.geometry.isnull().all():
-    print("Warning: No valid geometry found! Adding dummy geometry.")
-    meta["geometry"] = [Point(0, 0)] * len(meta)  # Placeholder geometry
+if VALIDATE:
+    # Ensure the geometry column is not empty
+    if meta.geometry.isnull().all():
+        print("Warning: No valid geometry found! Adding dummy geometry.")
+        meta["geometry"] = [Point(0, 0)] * len(meta)  # Placeholder geometry
 
-# Ensure the GeoDataFrame has a CRS
-if meta.crs is None:
-    print("Warning: No CRS found. Setting default to EPSG:4326")
-    meta.set_crs(epsg=4326, inplace=True)
+    # Ensure the GeoDataFrame has a CRS
+    if meta.crs is None:
+        print("Warning: No CRS found. Setting default to EPSG:4326")
+        meta.set_crs(epsg=4326, inplace=True)
 
 # Assign full file paths based on matching logic
-meta['filepath'] = meta['datafile'].apply(lambda x: find_closest_match_datafile(x, basenames))
+keys = meta['datafile'].str.rsplit('/', n=1).str[-1].str.split('_dn_').str[0]  # Vectorized basename prefix
+meta['filepath'] = keys.map(prefix_table)
+# Fall back to the binary prefix search only for the rows the table could not resolve
+missing = meta['filepath'].isnull()
+if missing.any():
+    meta.loc[missing, 'filepath'] = [find_closest_match_datafile(x, names, fullpaths) for x in meta.loc[missing, 'datafile']]
 print("Sample filepath assignments:\n", meta[['datafile', 'filepath']].head())
 
 # Filter out rows where no match was found
 meta = meta[meta['filepath'].notnull()]
 print(f"Filtered meta: {len(meta)} records remaining.")
-metacols = ['id', 'transect', 'datafile', 'epsg', 'random','geometry','filepath']
-meta = meta[metacols]
 
 # Define output filenames
 gpkg_fn1 = gpkg_fn.replace('.gpkg', '_locpaths.gpkg')  # Original CRS
@@ -56,17 +144,20 @@ csv_fn = gpkg_fn.replace('.gpkg', '_locpaths.csv')  # CSV version
 
 # Save the modified GeoPackage (Original CRS)
 print(f"Saving to {gpkg_fn1}...")
-meta.to_file(gpkg_fn1, driver="GPKG", overwrite=True)
+meta.to_file(gpkg_fn1, driver="GPKG", overwrite=True, engine="pyogrio")
 print("Saved successfully.")
 
 # Save the EPSG:4326 version
 meta_4326 = meta.to_crs(epsg=4326)  # Convert CRS
 print(f"Saving EPSG:4326 version to {gpkg_fn2}...")
-meta_4326.to_file(gpkg_fn2, driver="GPKG", overwrite=True)
+meta_4326.to_file(gpkg_fn2, driver="GPKG", overwrite=True, engine="pyogrio")
 print("EPSG:4326 file saved successfully.")
 
 # Save to CSV (without geometry)
 df = meta.drop(columns=['geometry'])  # Remove geometry before saving CSV
 print(f"Saving CSV version to {csv_fn}...")
-df.to_csv(csv_fn, index=False)
+if pa is not None:
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), csv_fn)  # C++ CSV writer
+else:
+    df.to_csv(csv_fn, index=False)
 print("CSV file saved successfully.")
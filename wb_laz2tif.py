@@ -1,15 +1,51 @@
-import pdal
 import os
+
+# The process pool provides the parallelism, so keep the OpenMP/BLAS runtimes single-threaded
+# (num_workers x CPU count threads would just fight over cache and disk). These are read when the
+# libraries load, so they must be set before numpy is imported through pdal/pandas.
+for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(var, '1')
+
+import pdal
 import time
+import json
+import functools
 import pandas as pd
+from osgeo import gdal
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 from uvars import las2tif_dpath, meta_csv_fn
 
 
-def laz_to_tif(laz_fn, tif_fn, epsg_code, res, window_size=10, nodata=-9999, dtm=True, reclassify=False):
+gdal.UseExceptions()
+
+
+def get_cog_options():
+    """
+    COG creation options for the output rasters: ZSTD when the GDAL build supports it, DEFLATE otherwise.
+    The floating-point predictor suits the float DTM/DSM values; BIGTIFF=IF_SAFER avoids the 4GB limit.
+    """
+    base = ["BLOCKSIZE=512", "BIGTIFF=IF_SAFER", "PREDICTOR=YES", "OVERVIEW_RESAMPLING=AVERAGE"]
+    creation_opts = gdal.GetDriverByName('COG').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    if 'ZSTD' in creation_opts:
+        return base + ["COMPRESS=ZSTD", "LEVEL=9"]
+    return base + ["COMPRESS=DEFLATE", "LEVEL=6"]
+
+
+COG_OPTIONS = get_cog_options()
+
+
+@functools.lru_cache(maxsize=64)
+def get_out_srs(epsg_code):
+    """Target SRS string for the reprojection filter, cached per EPSG code within each worker."""
+    return f"EPSG:{int(epsg_code)}"
+
+
+def laz_to_tif(laz_fn, tif_fn, epsg_code, res, window_size=10, nodata=-9999, dtm=True, reclassify=False, ground_filter='pmf'):
     """
-    Converts a LAZ file to a GeoTIFF using PDAL, with options for reprojection, classification filtering,
-    and DTM/DSM generation. Skips processing if the output file already exists.
+    Converts a LAZ file to a Cloud-Optimized GeoTIFF using PDAL, with options for reprojection, classification filtering,
+    and DTM/DSM generation. Skips processing if the output file already exists. Errors are printed and re-raised
+    so the caller can record the failure.
 
     Parameters:
         laz_fn (str): Path to the input LAZ file.
@@ -20,15 +56,19 @@ def laz_to_tif(laz_fn, tif_fn, epsg_code, res, window_size=10, nodata=-9999, dtm
         nodata (int): NoData value for the output raster (default: -9999).
         dtm (bool): If True, generate a Digital Terrain Model (DTM). Otherwise, generate a DSM (default: True).
         reclassify (bool): If True, apply classification filtering and reclassification (default: False).
+        ground_filter (str): Ground filter used when reclassifying: 'pmf' for the approximate progressive
+            morphological filter (fast), or 'smrf' for the slower, more accurate SMRF (default: 'pmf').
 
     Returns:
-        None
+        str: Path of the output TIFF (with the reclassification and ground filter suffix).
     """
     try:
-        # Check if the output file already exists
+        tif_fn = get_clf_fn(tif_fn, reclassify, ground_filter)
+
+        # Check if the output file already exists (the driver filters these out too, this stays defensive)
         if os.path.exists(tif_fn):
             print(f"Output file '{tif_fn}' already exists. Skipping processing.")
-            return
+            return tif_fn
 
         # Start timing the execution
         start_time = time.time()
@@ -37,46 +77,83 @@ def laz_to_tif(laz_fn, tif_fn, epsg_code, res, window_size=10, nodata=-9999, dtm
         pipeline = pdal.Reader(laz_fn)
 
         # Handle reclassification if enabled
+        # Noise points (class 7) keep their class and are skipped by the ground filter rather than
+        # removed by a separate pass; the final range filter drops them with the non-ground points
         if reclassify:
-            tif_fn = tif_fn.replace('.tif', '_yrclf.tif')
-            pipeline |= pdal.Filter.expression(expression="Classification != 7")  # Exclude noise points
-            pipeline |= pdal.Filter.assign(assignment="Classification[:]=0")      # Reclassify all points
-            pipeline |= pdal.Filter.reprojection(out_srs=f"EPSG:{epsg_code}")     # Reproject to target CRS
-            pipeline |= pdal.Filter.smrf()                                        # Apply SMRF ground filtering
+            pipeline |= pdal.Filter.assign(value="Classification = 0 WHERE Classification != 7")  # Reclassify all but noise
+            pipeline |= pdal.Filter.reprojection(out_srs=get_out_srs(epsg_code))   # Reproject to target CRS
+            if ground_filter == 'smrf':
+                pipeline |= pdal.Filter.smrf(ignore="Classification[7:7]")        # Apply SMRF ground filtering (high accuracy)
+            else:
+                pipeline |= pdal.Filter.pmf(ignore="Classification[7:7]", approximate=True, cell_size=1.0, slope=0.15, max_window_size=16)  # Approximate PMF (fast)
         else:
-            tif_fn = tif_fn.replace('.tif', '_nrclf.tif')
-            pipeline |= pdal.Filter.reprojection(out_srs=f"EPSG:{epsg_code}")     # Reproject without reclassification
+            pipeline |= pdal.Filter.reprojection(out_srs=get_out_srs(epsg_code))   # Reproject without reclassification
 
         # Filter points for DTM or DSM generation
         if dtm:
-            pipeline |= pdal.Filter.expression(expression="Classification == 2")  # Keep only ground points
+            pipeline |= pdal.Filter.range(limits="Classification[2:2]")           # Keep only ground points
         else:
+            if reclassify:
+                pipeline |= pdal.Filter.range(limits="Classification![7:7]")      # Exclude noise points
             print("Generating DSM (Digital Surface Model) by including all surface features such as buildings and vegetation.")
 
-        # Write the output to a GeoTIFF file
+        # Write the raster to GDAL's in-memory filesystem; it is translated to COG below
+        tmp_fn = f"/vsimem/{os.path.basename(tif_fn)}"
         pipeline |= pdal.Writer.gdal(
-            filename=tif_fn,
-            gdalopts="tiled=yes,compress=deflate",
+            filename=tmp_fn,
+            gdalopts="tiled=yes",
             nodata=nodata,
             output_type="idw",          # Use Inverse Distance Weighting for interpolation
             resolution=res,             # Set the resolution of the output raster
             window_size=window_size     # Set the window size for IDW
         )
 
-        # Execute the pipeline
-        pipeline.execute()
+        try:
+            # Execute the pipeline (returns the point count, so the point arrays are never pulled into Python)
+            point_count = pipeline.execute()
+
+            # Write the COG (tiles, overviews and compression) in a single pass
+            gdal.Translate(tif_fn, tmp_fn, format='COG', creationOptions=COG_OPTIONS)
+        finally:
+            # Free the in-memory raster even when PDAL fails part-way; workers are long-lived
+            if gdal.VSIStatL(tmp_fn) is not None:
+                gdal.Unlink(tmp_fn)
 
         # Calculate and print the execution time
         elapsed_time = time.time() - start_time
         print(f"Processing completed for {tif_fn} in {elapsed_time:.2f} seconds.")
 
         # Print summary information
-        point_count = len(pipeline.arrays[0]) if pipeline.arrays else 0
         print(f"Processed point cloud contains {point_count} points")
         print(f"Output saved to {tif_fn}")
+        return tif_fn
 
     except Exception as e:
         print(f"An error occurred during processing for {laz_fn}: {e}")
+        raise
+
+
+GROUND_FILTERS = ('pmf', 'smrf')
+
+
+def get_clf_fn(tif_fn, reclassify, ground_filter='pmf'):
+    """
+    Appends the reclassification suffix that tags every output TIFF. Reclassified PMF outputs are also
+    tagged '_pmf', so they never mix with SMRF tiles (which keep the original '_yrclf' name) on reruns.
+    Raises ValueError for a ground filter other than 'pmf' or 'smrf', before any name is built.
+    """
+    if ground_filter not in GROUND_FILTERS:
+        raise ValueError(f"ground_filter must be one of {GROUND_FILTERS}, got {ground_filter!r}")
+    if not reclassify:
+        return tif_fn.replace('.tif', '_nrclf.tif')
+    return tif_fn.replace('.tif', '_yrclf.tif' if ground_filter == 'smrf' else f'_yrclf_{ground_filter}.tif')
+
+
+def get_tif_fn(laz_fn, dname, res, window_size, vname, las2tif_dpath):
+    """Builds the output TIFF path for a LAZ file (before the reclassification suffix)."""
+    outdpath = os.path.join(las2tif_dpath, dname)
+    bname = os.path.basename(laz_fn).replace('.laz', '')
+    return os.path.join(outdpath, f"{bname}-{vname}{res}m_{window_size}.tif")
 
 
 def get_params(df, idx):
@@ -86,16 +163,81 @@ def get_params(df, idx):
     return dname, laz_fn, epsg_code
 
 
-def process_file(idx, df, res, window_size, nodata, vname, las2tif_dpath, dtm=True, reclassify=True):
+def process_file(rec, res, window_size, nodata, vname, las2tif_dpath, dtm=True, reclassify=True, ground_filter='pmf'):
     """
-    Helper function to process a single file. Used for parallel processing.
+    Helper function to process a single file record, a (transect, filepath, epsg) tuple.
     """
-    dname, laz_fn, epsg_code = get_params(df, idx)
-    outdpath = os.path.join(las2tif_dpath, dname)
-    bname = os.path.basename(laz_fn).replace('.laz', '')
-    os.makedirs(outdpath, exist_ok=True)
-    tif_fn = os.path.join(outdpath, f"{bname}-{vname}{res}m_{window_size}.tif")
-    laz_to_tif(laz_fn, tif_fn, epsg_code, res, window_size, nodata, dtm=dtm, reclassify=reclassify)
+    dname, laz_fn, epsg_code = rec
+    dname, epsg_code = str(dname), int(epsg_code)
+    tif_fn = get_tif_fn(laz_fn, dname, res, window_size, vname, las2tif_dpath)
+    os.makedirs(os.path.dirname(tif_fn), exist_ok=True)
+    return laz_to_tif(laz_fn, tif_fn, epsg_code, res, window_size, nodata, dtm=dtm, reclassify=reclassify, ground_filter=ground_filter)
+
+
+def _init_gdal_env():
+    """
+    Pool initializer: GDAL settings for each worker process, applied before any PDAL/GDAL work.
+    Skips the sibling directory listing on open, enlarges the block cache, keeps GDAL single-threaded
+    since the process pool already provides the parallelism (the OpenMP/BLAS limits are set at import),
+    and keeps PROJ off the network so each worker resolves CRSs from the local database only.
+    """
+    os.environ['GDAL_DISABLE_READDIR_ON_OPEN'] = 'EMPTY_DIR'
+    os.environ['GDAL_CACHEMAX'] = '1024'
+    os.environ['GDAL_NUM_THREADS'] = '1'
+    os.environ['PROJ_NETWORK'] = 'OFF'
+
+
+def append_manifest(manifest_fn, entry):
+    """Appends one entry to the manifest as a single line write, so concurrent workers do not interleave."""
+    with open(manifest_fn, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def process_batch(batch, res, window_size, nodata, vname, las2tif_dpath, manifest_fn, dtm=True, reclassify=True, ground_filter='pmf', fail_fast=False):
+    """
+    Processes a batch of file records sequentially inside one worker. Used for parallel processing,
+    so PDAL/GDAL start-up and task IPC are paid once per batch rather than once per file.
+    Each file's entry is appended to the manifest as soon as it finishes, so a crash loses no completed
+    files; the entries are also returned. With fail_fast the batch stops at its first failure.
+    """
+    results = []
+    for rec in batch:
+        try:
+            tif_fn = process_file(rec, res, window_size, nodata, vname, las2tif_dpath, dtm=dtm, reclassify=reclassify, ground_filter=ground_filter)
+            entry = {'status': 'ok', 'laz_fn': rec[1], 'tif_fn': tif_fn}
+        except Exception as e:
+            entry = {'status': 'fail', 'laz_fn': rec[1], 'error': repr(e)}
+        append_manifest(manifest_fn, entry)
+        results.append(entry)
+        if fail_fast and entry['status'] == 'fail':
+            break
+    return results
+
+
+def get_size(fn):
+    """File size in bytes, or 0 if it cannot be read; the worker then records the failure in the manifest."""
+    try:
+        return os.path.getsize(fn)
+    except OSError:
+        return 0
+
+
+def load_manifest(manifest_fn):
+    """
+    Returns the output TIFFs recorded as done in a previous run's manifest (empty if there is none).
+    Lines that do not parse, e.g. one truncated by a killed run, are skipped.
+    """
+    done = set()
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry['status'] == 'ok':
+                    done.add(entry['tif_fn'])
+    return done
 
 
 if __name__ == "__main__":
@@ -106,24 +248,80 @@ if __name__ == "__main__":
     vname = 'DTM'  # Output file name prefix
     nodata = -9999  # NoData value for the output raster
     num_workers = 20  # Number of parallel workers
+    dtm = True  # Generate a DTM (ground points only)
+    reclassify = True  # Reclassify ground points
+    ground_filter = 'pmf'  # 'pmf' (approximate, fast) or 'smrf' (slower, higher accuracy)
+    fail_fast = False  # Stop the whole run at the first failed file
+    manifest_fn = os.path.join(las2tif_dpath, '_manifest.jsonl')  # Per-file results, used to resume reruns
+    max_batch_size = 8  # Cap on files per batch, so results and progress come back often
 
     # Load metadata CSV
     df = pd.read_csv(meta_csv_fn)
 
+    # Only submit rows whose output does not exist yet, so reruns skip the worker round-trip.
+    # Files recorded in the manifest are skipped without touching the filesystem.
+    done = load_manifest(manifest_fn)
+    work_idx = []
+    for idx in range(len(df)):
+        #if idx > 3: break # Limit to first 4 rows for testing purposes
+        dname, laz_fn, _ = get_params(df, idx)
+        tif_fn = get_clf_fn(get_tif_fn(laz_fn, dname, res, window_size, vname, las2tif_dpath), reclassify, ground_filter)
+        if tif_fn not in done and not os.path.exists(tif_fn):
+            work_idx.append(idx)
+    print(f"{len(df) - len(work_idx)} of {len(df)} files already processed, {len(work_idx)} to go.")
+
+    # Largest tiles first (longest-processing-time-first), so the run does not end on one worker with a huge tile
+    sizes = {idx: get_size(df['filepath'][idx]) for idx in work_idx}
+    work_idx.sort(key=sizes.get, reverse=True)
+
+    # Ship only the needed columns as small tuples, in batches of ~4 per worker (at most max_batch_size files).
+    # The sorted files are dealt round-robin so every batch gets a mix of large and small tiles,
+    # then the batches are submitted heaviest first.
+    records = list(df[['transect', 'filepath', 'epsg']].itertuples(index=False, name=None))
+    chunksize = min(max_batch_size, max(1, len(work_idx) // (num_workers * 4)))
+    n_batches = -(-len(work_idx) // chunksize)
+    batch_idx = [[] for _ in range(n_batches)]
+    for i, idx in enumerate(work_idx):
+        batch_idx[i % n_batches].append(idx)
+    batch_idx.sort(key=lambda b: sum(sizes[idx] for idx in b), reverse=True)
+    batches = [[records[idx] for idx in b] for b in batch_idx]
+
     # Use ProcessPoolExecutor for parallel processing
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        futures = []
-        for idx in range(len(df)):
-            #if idx > 3: break # Limit to first 4 rows for testing purposes
-                
-            futures.append(executor.submit(process_file, idx, df, res, window_size, nodata, vname, las2tif_dpath, dtm=True, reclassify=True))
-
-        # Wait for all futures to complete and handle results
+    results = {'ok': [], 'fail': []}
+    os.makedirs(las2tif_dpath, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_gdal_env) as executor, \
+            tqdm(total=len(work_idx), unit='file') as progress:
+        futures = {}
+        for batch in batches:
+            future = executor.submit(process_batch, batch, res, window_size, nodata, vname, las2tif_dpath, manifest_fn, dtm=dtm, reclassify=reclassify, ground_filter=ground_filter, fail_fast=fail_fast)
+            futures[future] = batch
+
+        # Collect per-file results as batches complete (the workers have already written them to the manifest)
         for future in as_completed(futures):
             try:
-                future.result()  # Raise any exceptions that occurred during processing
-            except Exception as e:
-                print(f"Error during parallel processing: {e}")
-    
+                entries = future.result()
+            except Exception as e:  # The worker itself died; files it finished are already in the manifest
+                finished = load_manifest(manifest_fn)
+                entries = []
+                for rec in futures[future]:
+                    tif_fn = get_clf_fn(get_tif_fn(rec[1], str(rec[0]), res, window_size, vname, las2tif_dpath), reclassify, ground_filter)
+                    if tif_fn in finished:
+                        entries.append({'status': 'ok', 'laz_fn': rec[1], 'tif_fn': tif_fn})
+                    else:
+                        entry = {'status': 'fail', 'laz_fn': rec[1], 'error': repr(e)}
+                        append_manifest(manifest_fn, entry)
+                        entries.append(entry)
+            for entry in entries:
+                results[entry['status']].append(entry)
+            progress.update(len(entries))
+
+            if fail_fast and results['fail']:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise RuntimeError(f"Stopping after failure on {results['fail'][0]['laz_fn']}: {results['fail'][0]['error']}")
+
+    print(f"{len(results['ok'])} files succeeded, {len(results['fail'])} failed.")
+    for entry in results['fail']:
+        print(f"FAILED {entry['laz_fn']}: {entry['error']}")
+
     tf = time.perf_counter() - ti 
     print(f"RUN.TIME {tf/60} min(s)")
\ No newline at end of file
@@ -1,6 +1,8 @@
 from glob import glob 
 import os 
+from wb_laz2tif import get_clf_fn
 
 
-fpattern = "/media/ljp238/12TBWolf/ARCHIEVE/EBA3ROIsBrazilianAmazonPointCloudTransact/PC2TIF/*/*DTM30m_10_yrclf.tif"
-files = glob(fpattern); print(f'{len(files)} files')
\ No newline at end of file
+ground_filter = 'pmf'  # Must match the ground_filter of the wb_laz2tif run ('pmf' or 'smrf')
+fpattern = get_clf_fn("/media/ljp238/12TBWolf/ARCHIEVE/EBA3ROIsBrazilianAmazonPointCloudTransact/PC2TIF/*/*DTM30m_10.tif", True, ground_filter)
+files = glob(fpattern); print(f'{len(files)} files')